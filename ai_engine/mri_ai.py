@@ -1,14 +1,32 @@
 # ai_engine/mri_ai.py
 import google.generativeai as genai
-import re, json, os
+import json, os
+import atexit
+import copy
+import hashlib
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
 from PIL import Image
 import pdfplumber
-import pytesseract
+import fitz  # PyMuPDF
+from tesserocr import PyTessBaseAPI, OEM
 
 # ---- configure: replace with your key ----
 genai.configure(api_key="GEMINI_API_KEY")
 model = genai.GenerativeModel("models/gemini-2.5-flash")
 
+# ---- OCR: one tesseract engine per process (init is expensive) ----
+# PyTessBaseAPI is not thread-safe, so every call goes through _TESS_LOCK.
+# Created lazily on first OCR so the app still starts (and non-OCR endpoints
+# keep working) when tesseract or its language data is missing.
+_TESS_API = None
+_TESS_FAILED = False
+_TESS_LOCK = threading.Lock()
+
 PROMPT_TEMPLATE = """
 You are a certified medical fitness assistant.
 Analyze the following medical report and generate a 7-day safe exercise and diet plan 
@@ -33,63 +51,384 @@ Rules:
 }}
 """
 
-def extract_text_from_pdf(path):
-    text = ""
+# analyze_report results keyed by a hash of the whitespace-normalized report
+_RESULT_CACHE = OrderedDict()
+_RESULT_CACHE_SIZE = 512
+_RESULT_LOCK = threading.Lock()
+
+# pages with fewer chars than this in their text layer are treated as scans
+TEXT_LAYER_MIN_CHARS = 50
+OCR_DPI = 200
+
+# per-document page routing (True = text layer, False = OCR), keyed by file hash
+_ROUTE_CACHE = OrderedDict()
+_ROUTE_CACHE_SIZE = 256
+_ROUTE_LOCK = threading.Lock()
+
+# tesseract already uses ~4 cores per instance, so size the pool accordingly
+OCR_WORKERS = max(1, (os.cpu_count() or 1) // 4)
+_OCR_POOL = None
+_OCR_POOL_LOCK = threading.Lock()
+
+def _get_tess_api():
+    """The process' tesseract engine, or None if it can't be created (caller holds _TESS_LOCK)."""
+    global _TESS_API, _TESS_FAILED
+    if _TESS_API is None and not _TESS_FAILED:
+        try:
+            _TESS_API = PyTessBaseAPI(lang="eng", oem=OEM.LSTM_ONLY)
+            # pool workers leave through os._exit, atexit never runs there
+            if multiprocessing.parent_process() is None:
+                atexit.register(_TESS_API.End)
+        except Exception:
+            _TESS_FAILED = True
+    return _TESS_API
+
+def _ocr_image(img):
+    with _TESS_LOCK:
+        api = _get_tess_api()
+        if api is None:
+            return ""
+        api.SetImage(img)
+        return api.GetUTF8Text()
+
+def _ocr_frames(img):
+    # multi-page TIFFs: reuse the same engine for every frame
+    pages = []
+    for i in range(getattr(img, "n_frames", 1)):
+        img.seek(i)
+        pages.append(_ocr_image(img))
+    return "\n".join(pages)
+
+def _init_ocr_worker():
+    # workers start from a clean interpreter, so warm up their own engine
+    with _TESS_LOCK:
+        _get_tess_api()
+
+def _ocr_worker(src):
+    """Pool task: src is encoded image bytes or an image path."""
     try:
-        with pdfplumber.open(path) as pdf:
-            for page in pdf.pages:
-                text += page.extract_text() or ""
+        img = Image.open(BytesIO(src) if isinstance(src, bytes) else src)
+        return _ocr_frames(img)
     except Exception:
         return ""
-    return text
 
-def extract_text_from_image(path):
+def _get_ocr_pool():
+    global _OCR_POOL
+    with _OCR_POOL_LOCK:
+        if _OCR_POOL is None:
+            # never fork the server: it is multi-threaded and may be inside
+            # tesseract/OpenMP, whose state a forked child would inherit
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _OCR_POOL = ProcessPoolExecutor(max_workers=OCR_WORKERS,
+                                            mp_context=multiprocessing.get_context(method),
+                                            initializer=_init_ocr_worker)
+            atexit.register(_OCR_POOL.shutdown)
+        return _OCR_POOL
+
+def _discard_ocr_pool(pool):
+    global _OCR_POOL
+    with _OCR_POOL_LOCK:
+        if _OCR_POOL is pool:
+            _OCR_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _run_ocr_tasks(fn, tasks, failed):
+    """
+    Map fn over tasks, in the pool when there is something to parallelize.
+    If a worker dies (tesseract crash, OOM) the pool is replaced and the batch
+    retried once; after that each task yields `failed`. A crashed batch is
+    never re-run in this process, it would take the server down with it.
+    """
+    if len(tasks) <= 1 or OCR_WORKERS == 1:
+        return [fn(t) for t in tasks]
+    for _ in range(2):
+        pool = _get_ocr_pool()
+        try:
+            return list(pool.map(fn, tasks))
+        except BrokenProcessPool:
+            _discard_ocr_pool(pool)
+    return [failed] * len(tasks)
+
+def _ocr_many(sources):
+    """OCR several images, in parallel when it pays off. Keeps input order."""
+    return _run_ocr_tasks(_ocr_worker, sources, "")
+
+def _ocr_pdf_pages(task):
+    """
+    Pool task: (pdf path or bytes, page indices). Pages are rasterized here,
+    one at a time and in grayscale, so only a single page bitmap is alive per
+    worker and none has to be pickled back from the parent.
+    """
+    data, page_indices = task
+    doc = fitz.open(data) if _is_path(data) else fitz.open(stream=data, filetype="pdf")
+    texts = []
+    with doc:
+        for i in page_indices:
+            try:
+                pix = doc[i].get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY, alpha=False)
+                img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+                del pix
+                texts.append(_ocr_image(img))
+            except Exception:
+                texts.append("")
+    return texts
+
+def _ocr_pdf(src, scans):
+    """OCR the given pages of a PDF, split across the pool. Keeps page order."""
+    if _is_path(src):
+        data = src
+    else:
+        src.seek(0)
+        data = src.read()
+    n = min(OCR_WORKERS, len(scans))
+    chunks = [scans[k::n] for k in range(n)]
+    texts = {}
+    for chunk, chunk_texts in zip(chunks, _run_ocr_tasks(_ocr_pdf_pages, [(data, c) for c in chunks], None)):
+        for i, page_text in zip(chunk, chunk_texts or [""] * len(chunk)):
+            texts[i] = page_text
+    return [texts[i] for i in scans]
+
+def _is_path(src):
+    return isinstance(src, (str, os.PathLike))
+
+def _file_digest(src):
+    """Hash a path or a seekable file object (rewound afterwards)."""
+    h = hashlib.blake2b(digest_size=16)
+    if _is_path(src):
+        with open(src, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+    else:
+        src.seek(0)
+        for chunk in iter(lambda: src.read(1 << 16), b""):
+            h.update(chunk)
+        src.seek(0)
+    return h.hexdigest()
+
+def _get_routes(digest):
+    with _ROUTE_LOCK:
+        routes = _ROUTE_CACHE.get(digest)
+        if routes is not None:
+            _ROUTE_CACHE.move_to_end(digest)
+        return routes
+
+def _put_routes(digest, routes):
+    with _ROUTE_LOCK:
+        _ROUTE_CACHE[digest] = routes
+        _ROUTE_CACHE.move_to_end(digest)
+        while len(_ROUTE_CACHE) > _ROUTE_CACHE_SIZE:
+            _ROUTE_CACHE.popitem(last=False)
+
+def extract_text_from_pdf(src):
+    """
+    Per page: use the embedded text layer when there is one (born-digital),
+    otherwise rasterize and OCR. The routing is cached per document hash.
+    src may be a path or a binary file object.
+    """
     try:
-        return pytesseract.image_to_string(Image.open(path))
+        digest = _file_digest(src)
+        routes = _get_routes(digest)
+        with pdfplumber.open(src) as pdf:
+            if routes is None:
+                routes = tuple(len(page.chars) > TEXT_LAYER_MIN_CHARS for page in pdf.pages)
+                _put_routes(digest, routes)
+            texts = [""] * len(routes)
+            scans = []  # indices of pages that need OCR
+            for i, (page, has_text) in enumerate(zip(pdf.pages, routes)):
+                if has_text:
+                    texts[i] = page.extract_text() or ""
+                else:
+                    scans.append(i)
+        if scans:
+            # pdfplumber's renderer is slow; MuPDF rasterizes natively
+            for i, page_text in zip(scans, _ocr_pdf(src, scans)):
+                texts[i] = page_text
     except Exception:
         return ""
+    return "".join(texts)
 
-def extract_text_from_file(path):
-    p = path.lower()
+def extract_text_from_image(src):
+    """src may be a path or a binary file object."""
+    try:
+        return _ocr_frames(Image.open(src))
+    except Exception:
+        return ""
+
+def extract_text_from_images(sources):
+    """Batch OCR for several uploaded images; returns texts in input order."""
+    # file objects can't cross the process boundary, ship their bytes instead
+    sources = [src if _is_path(src) else src.read() for src in sources]
+    return _ocr_many(sources)
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+
+def _is_image(src, filename=None):
+    return (filename or str(src)).lower().endswith(IMAGE_EXTS)
+
+def extract_text_from_file(src, filename=None):
+    """
+    src is a path or a binary file object; for file objects pass the original
+    filename so the type can be detected from its extension.
+    """
+    p = (filename or str(src)).lower()
     if p.endswith(".pdf"):
-        return extract_text_from_pdf(path)
-    if p.endswith((".jpg", ".jpeg", ".png")):
-        return extract_text_from_image(path)
+        return extract_text_from_pdf(src)
+    if p.endswith(IMAGE_EXTS):
+        return extract_text_from_image(src)
     # fallback: read as text
     try:
-        with open(path, "r", encoding="utf-8") as f:
+        if not _is_path(src):
+            return src.read().decode("utf-8")
+        with open(src, "r", encoding="utf-8") as f:
             return f.read()
     except Exception:
         return ""
 
+def extract_text_from_files(sources, filenames=None):
+    """
+    Extract text from several uploads at once. Images are OCR'd as one batch;
+    everything else goes through extract_text_from_file. Keeps input order.
+    """
+    filenames = filenames or [None] * len(sources)
+    texts = [""] * len(sources)
+    image_idx = [i for i, src in enumerate(sources) if _is_image(src, filenames[i])]
+    for i, text in zip(image_idx, extract_text_from_images([sources[i] for i in image_idx])):
+        texts[i] = text
+    for i, src in enumerate(sources):
+        if i not in image_idx:
+            texts[i] = extract_text_from_file(src, filenames[i])
+    return texts
+
+def _generate(report_text, stream=False):
+    return model.generate_content(PROMPT_TEMPLATE.format(report_text=report_text), stream=stream)
+
+def _report_key(report_text):
+    normalized = " ".join(report_text.split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+def _cache_get(key):
+    with _RESULT_LOCK:
+        cached = _RESULT_CACHE.get(key)
+        if cached is None:
+            return None
+        _RESULT_CACHE.move_to_end(key)
+    # callers add fields (ml_recommendation) to the result, hand out copies
+    return copy.deepcopy(cached)
+
+def _cache_put(key, result):
+    with _RESULT_LOCK:
+        _RESULT_CACHE[key] = copy.deepcopy(result)
+        while len(_RESULT_CACHE) > _RESULT_CACHE_SIZE:
+            _RESULT_CACHE.popitem(last=False)
+
 def analyze_report(report_text: str):
     """
     Uses Gemini to analyze. Includes robust JSON extraction and fallback.
+    Results are memoized per report content, so re-uploads skip the LLM call.
+    """
+    key = _report_key(report_text)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+    result, parsed = _analyze_report(report_text)
+    if parsed:
+        _cache_put(key, result)
+    return result
+
+def _analyze_report(report_text):
+    """(result, parsed): only parsed results are worth caching, a retry may fix the rest"""
+    try:
+        response = _generate(report_text)
+        return _parse_ai_text(response.text)
+    except Exception as e:
+        return {"error": str(e)}, False
+
+_JSON_DECODER = json.JSONDecoder()
+
+def _parse_ai_text(ai_text):
     """
-    prompt = PROMPT_TEMPLATE.format(report_text=report_text)
+    Returns (result, parsed). parsed is False when the output held no usable
+    JSON and result is the "Unknown" fallback built from the raw text.
+    """
+    # literal "\n" escapes become spaces; then collapse all whitespace runs
+    ai_text = " ".join(ai_text.replace("\\n", " ").split())
+
+    # decode the first complete JSON object; raw_decode stops at its end
+    start = ai_text.find("{")
     try:
-        response = model.generate_content(prompt)
-        ai_text = response.text.strip()
-        ai_text = ai_text.replace("\\n", " ").replace("\r", " ")
-        ai_text = re.sub(r"\s+", " ", ai_text).strip()
+        if start < 0:
+            raise ValueError("no JSON object in output")
+        ai_json, _ = _JSON_DECODER.raw_decode(ai_text, start)
+    except ValueError:
+        ai_json = {"raw_output": ai_text}
 
-        match = re.search(r'\{[\s\S]*\}', ai_text)
-        json_str = match.group(0) if match else ai_text
+    # ensure minimal structure
+    if "conditions" not in ai_json:
+        ai_json = {
+            "conditions": ["Unknown"],
+            "exercise_plan": [],
+            "diet_plan": [],
+            "precautions": [],
+            "summary": ai_json.get("raw_output", "No structured data.")
+        }
+        return ai_json, False
+    return ai_json, True
 
-        try:
-            ai_json = json.loads(json_str)
-        except Exception:
-            ai_json = {"raw_output": ai_text}
-
-        # ensure minimal structure
-        if "conditions" not in ai_json:
-            ai_json = {
-                "conditions": ["Unknown"],
-                "exercise_plan": [],
-                "diet_plan": [],
-                "precautions": [],
-                "summary": ai_json.get("raw_output", "No structured data.")
-            }
-        return ai_json
+class _JsonObjectScanner:
+    """Tracks brace depth over streamed text; done once the first object closes."""
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+        self.done = False
+
+    def feed(self, text):
+        for ch in text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"' and self.started:
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+                self.started = True
+            elif ch == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.done = True
+                    break
+        return self.done
+
+def analyze_report_stream(report_text: str):
+    """
+    Streaming variant of analyze_report. Yields ("chunk", text) as Gemini
+    output arrives, then ("result", dict) with the same shape analyze_report
+    returns. Reading stops as soon as the JSON object in the output is complete.
+    """
+    key = _report_key(report_text)
+    cached = _cache_get(key)
+    if cached is not None:
+        yield "result", cached
+        return
+
+    try:
+        scanner = _JsonObjectScanner()
+        parts = []
+        for chunk in _generate(report_text, stream=True):
+            text = chunk.text
+            parts.append(text)
+            yield "chunk", text
+            if scanner.feed(text):
+                break
+        result, parsed = _parse_ai_text("".join(parts))
     except Exception as e:
-        return {"error": str(e)}
+        result, parsed = {"error": str(e)}, False
+    if parsed:
+        _cache_put(key, result)
+    yield "result", result
@@ -1,12 +1,15 @@
 # app.py
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, Response, request, jsonify, send_file, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-import tempfile, os, json
+from flask_compress import Compress
+import tempfile
 from io import BytesIO
+import orjson
 
 # local modules
-from ai_engine.mri_ai import analyze_report, extract_text_from_file
-from ml_recommender import predict_workout
+from ai_engine.mri_ai import analyze_report, analyze_report_stream, extract_text_from_files
+from ml_recommender import predict_workout, predict_workout_batch
 import gamification
 
 # PDF generation
@@ -15,8 +18,64 @@ from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
 
+# uploads up to this size stay in memory, larger ones spill to disk
+UPLOAD_SPOOL_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = 32 * 1024 * 1024
+
+class SpooledRequest(Request):
+    # werkzeug streams each multipart file part straight into this object,
+    # so the upload is never copied into a second temp file
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+
+class OrjsonProvider(JSONProvider):
+    # orjson encodes straight to bytes, so jsonify skips the str -> bytes step
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+                                        mimetype="application/json")
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.request_class = SpooledRequest
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_SIZE
+# gzip JSON (leaderboards, histories); leave streamed SSE responses alone
+app.config["COMPRESS_STREAMS"] = False
 CORS(app)
+Compress(app)
+
+# ReportLab styles are built once and shared by every /api/report call
+_STYLES = getSampleStyleSheet()
+_STYLES.add(ParagraphStyle(name="SectionTitle",
+                           fontSize=14,
+                           leading=16,
+                           textColor=colors.white,
+                           backColor=colors.HexColor("#004aad"),
+                           alignment=1))
+_STYLES.add(ParagraphStyle(name="BodyTextCustom",
+                           fontSize=11,
+                           leading=14))
+_TITLE_STYLE = _STYLES['Title']
+_WRAP_STYLE = ParagraphStyle(name="TableWrap",
+                             fontSize=10,
+                             leading=13,
+                             alignment=0)
+_GRID_STYLE = TableStyle([("GRID", (0,0), (-1,-1), 0.5, colors.grey),
+                          ("FONTNAME", (0,0), (-1,0), "Helvetica-Bold")])
+# fixed plan-table widths (A4 minus margins) so ReportLab skips auto-sizing
+_PLAN_COL_WIDTHS = [40, 460]
+
+def _plan_table(header, plan, key):
+    """Day/items table for exercise_plan ("exercises") or diet_plan ("meals")."""
+    rows = [["Day", header]] + [[str(day["day"]), Paragraph(", ".join(day[key]), _WRAP_STYLE)]
+                                for day in plan]
+    return Table(rows, colWidths=_PLAN_COL_WIDTHS, style=_GRID_STYLE)
 
 @app.route("/")
 def home():
@@ -29,50 +88,104 @@ def home():
 def api_analyze():
     """
     Expects multipart form:
-      - file: uploaded pdf/image/txt
+      - file: uploaded pdf/image/txt (may be repeated for multi-file reports)
       - user_id: (optional) string to award upload XP in gamification DB
       - age, bmi, experience_level, pain_level (optional) json fields for ML recommender
     """
     if 'file' not in request.files:
         return jsonify({"error": "No file part"}), 400
 
-    f = request.files['file']
-    # save temporary
-    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(f.filename)[1]) as tmp:
-        f.save(tmp.name)
-        tmp_path = tmp.name
+    text = _extract_uploaded_text()
+    result = analyze_report(text)
+    ml_rec = _ml_recommendation()
+    if ml_rec is not None:
+        result["ml_recommendation"] = ml_rec
+    _award_upload_xp()
+
+    return jsonify(result)
+
+@app.route("/api/analyze/stream", methods=["POST"])
+def api_analyze_stream():
+    """
+    Same form fields as /api/analyze, answered as server-sent events:
+      - event "chunk": {"text": ...} raw Gemini output as it arrives
+      - event "result": the final JSON (same shape as /api/analyze)
+    """
+    if 'file' not in request.files:
+        return jsonify({"error": "No file part"}), 400
+
+    text = _extract_uploaded_text()
+    ml_rec = _ml_recommendation()
+    _award_upload_xp()
+
+    def events():
+        for kind, payload in analyze_report_stream(text):
+            if kind == "chunk":
+                payload = {"text": payload}
+            elif ml_rec is not None:
+                payload["ml_recommendation"] = ml_rec
+            yield f"event: {kind}\ndata: {app.json.dumps(payload)}\n\n"
 
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def _extract_uploaded_text():
+    files = request.files.getlist('file')
+    # uploads are already spooled (memory or disk) by SpooledRequest
+    buffers = []
+    for f in files:
+        f.stream.seek(0)
+        buffers.append(f.stream)
+    return "\n\n".join(extract_text_from_files(buffers, [f.filename for f in files]))
+
+def _ml_recommendation():
+    # optional: call local ML recommender if client sent relevant fields
+    if not request.form.get("age"):
+        return None
     try:
-        text = extract_text_from_file(tmp_path)
-        result = analyze_report(text)
-
-        # optional: call local ML recommender if client sent relevant fields
-        ml_input = {}
-        if request.form.get("age"):
-            try:
-                ml_input = {
-                    "age": int(request.form.get("age")),
-                    "bmi": float(request.form.get("bmi", 24.0)),
-                    "condition": request.form.get("condition", "None"),
-                    "experience_level": request.form.get("experience_level", "Beginner"),
-                    "pain_level": int(request.form.get("pain_level", 0))
-                }
-                ml_pred = predict_workout(**ml_input)
-                result["ml_recommendation"] = {"workout_type": ml_pred}
-            except Exception:
-                result["ml_recommendation"] = {"error": "ml predict failed"}
-
-        # award upload XP if user_id included
-        user_id = request.form.get("user_id")
-        if user_id:
-            gamification.mark_upload(user_id, note=f"Uploaded {f.filename}")
-
-        return jsonify(result)
-    finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+        ml_input = {
+            "age": int(request.form.get("age")),
+            "bmi": float(request.form.get("bmi", 24.0)),
+            "condition": request.form.get("condition", "None"),
+            "experience_level": request.form.get("experience_level", "Beginner"),
+            "pain_level": int(request.form.get("pain_level", 0))
+        }
+        ml_pred = predict_workout(**ml_input)
+        return {"workout_type": ml_pred}
+    except Exception:
+        return {"error": "ml predict failed"}
+
+def _award_upload_xp():
+    # award upload XP if user_id included
+    user_id = request.form.get("user_id")
+    if user_id:
+        names = ", ".join(f.filename for f in request.files.getlist('file'))
+        gamification.mark_upload(user_id, note=f"Uploaded {names}")
+
+# ----------------------
+# Batch workout recommendation (POST JSON)
+# ----------------------
+@app.route("/api/recommend/batch", methods=["POST"])
+def api_recommend_batch():
+    """
+    Expects JSON: {"records": [{age, bmi, condition, experience_level, pain_level}, ...]}
+    Returns {"workout_types": [...]} in the same order.
+    """
+    payload = request.get_json(silent=True) or {}
+    records = payload.get("records")
+    if not isinstance(records, list):
+        return jsonify({"error": "send JSON with key 'records' (list)"}), 400
+    try:
+        records = [{
+            "age": int(r.get("age", 30)),
+            "bmi": float(r.get("bmi", 24.0)),
+            "condition": str(r.get("condition") or "None"),
+            "experience_level": str(r.get("experience_level") or "Beginner"),
+            "pain_level": int(r.get("pain_level", 0))
+        } for r in records]
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({"error": "invalid record"}), 400
+    return jsonify({"workout_types": [str(w) for w in predict_workout_batch(records)]})
 
 # ----------------------
 # Generate a printable PDF report from JSON result (POST JSON)
@@ -92,25 +205,10 @@ def api_report():
                             rightMargin=40, leftMargin=40,
                             topMargin=60, bottomMargin=40)
     elements = []
-    styles = getSampleStyleSheet()
-    styles.add(ParagraphStyle(name="SectionTitle",
-                              fontSize=14,
-                              leading=16,
-                              textColor=colors.white,
-                              backColor=colors.HexColor("#004aad"),
-                              alignment=1))
-
-    styles.add(ParagraphStyle(name="BodyTextCustom",
-                              fontSize=11,
-                              leading=14))
-
-    wrap_style = ParagraphStyle(name="TableWrap",
-                                fontSize=10,
-                                leading=13,
-                                alignment=0)
+    styles = _STYLES
 
     # Title
-    elements.append(Paragraph("<b>FitGenesis AI – Personalized Fitness Report</b>", styles['Title']))
+    elements.append(Paragraph("<b>FitGenesis AI – Personalized Fitness Report</b>", _TITLE_STYLE))
     elements.append(Spacer(1, 12))
 
     # Conditions
@@ -122,23 +220,13 @@ def api_report():
     # Exercise plan
     elements.append(Paragraph("Exercise Plan", styles['SectionTitle']))
     if result.get("exercise_plan"):
-        data = [["Day", "Exercises"]]
-        for day in result["exercise_plan"]:
-            data.append([str(day["day"]), ", ".join(day["exercises"])])
-        table = Table(data)
-        table.setStyle(TableStyle([("GRID", (0,0), (-1,-1), 0.5, colors.grey)]))
-        elements.append(table)
+        elements.append(_plan_table("Exercises", result["exercise_plan"], "exercises"))
     elements.append(Spacer(1, 10))
 
     # Diet Plan
     elements.append(Paragraph("Diet Plan", styles['SectionTitle']))
     if result.get("diet_plan"):
-        data = [["Day", "Meals"]]
-        for day in result["diet_plan"]:
-            data.append([str(day["day"]), ", ".join(day["meals"])])
-        table = Table(data)
-        table.setStyle(TableStyle([("GRID", (0,0), (-1,-1), 0.5, colors.grey)]))
-        elements.append(table)
+        elements.append(_plan_table("Meals", result["diet_plan"], "meals"))
     elements.append(Spacer(1, 10))
 
     # Precautions
@@ -153,14 +241,10 @@ def api_report():
 
     doc.build(elements)
 
-    pdf_bytes = buffer.getvalue()
-    buffer.close()
-
-    # Return raw PDF bytes directly
-    return pdf_bytes, 200, {
-        "Content-Type": "application/pdf",
-        "Content-Disposition": "attachment; filename=FitGenesis_Report.pdf"
-    }
+    # stream the buffer itself instead of copying it out with getvalue()
+    buffer.seek(0)
+    return send_file(buffer, mimetype="application/pdf", as_attachment=True,
+                     download_name="FitGenesis_Report.pdf")
 
 # ----------------------
 # Gamification endpoints (wrap gamification.py)
@@ -198,9 +282,32 @@ def route_mark_upload(user_id):
 
 @app.route("/api/leaderboard", methods=["GET"])
 def route_leaderboard():
+    """
+    ?top=N, optional ?fields=name,xp,... to return only those keys.
+    "rank" is accepted as a field (dense rank by XP).
+    """
     top = int(request.args.get("top", 10))
-    lb = gamification.get_leaderboard(top)
-    return jsonify(lb)
+    fields = request.args.get("fields")
+    if not fields:
+        return jsonify(gamification.get_leaderboard(top))
+
+    wanted = [f.strip() for f in fields.split(",") if f.strip()]
+    lb = gamification.get_leaderboard(top, with_history="history" in wanted)
+    rows = []
+    rank, prev = 0, None
+    for u in lb:
+        # lb is sorted by xp, so dense rank is a running count of distinct values
+        if u["xp"] != prev:
+            rank, prev = rank + 1, u["xp"]
+        rows.append({k: rank if k == "rank" else u.get(k) for k in wanted})
+    return jsonify(rows)
+
+@app.route("/api/user/<user_id>/rank", methods=["GET"])
+def route_user_rank(user_id):
+    rank = gamification.get_rank(user_id)
+    if not rank:
+        return jsonify({"error": "not found"}), 404
+    return jsonify(rank)
 
 if __name__ == "__main__":
     app.run(debug=True, port=5000)
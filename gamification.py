@@ -1,12 +1,16 @@
 # gamification.py
-import json
+import orjson
+import sqlite3
+import threading
+import atexit
+from collections import OrderedDict
 from pathlib import Path
-from datetime import datetime, timedelta
-import tempfile
-import os
+from datetime import date
 
-DATA_FILE = Path("data/progress_db.json")
-DATA_FILE.parent.mkdir(parents=True, exist_ok=True)
+DB_FILE = Path("data/progress.db")
+# old JSON store, imported once into an empty SQLite DB
+LEGACY_DATA_FILE = Path("data/progress_db.json")
+DB_FILE.parent.mkdir(parents=True, exist_ok=True)
 
 # thresholds for badges (XP)
 BADGE_THRESHOLDS = {
@@ -15,6 +19,7 @@ BADGE_THRESHOLDS = {
     200: "Wellness Warrior",
     400: "Health Hero"
 }
+_SORTED_THRESHOLDS = sorted(BADGE_THRESHOLDS.items())
 
 DEFAULT_USER_TEMPLATE = {
     "user_id": "",
@@ -26,163 +31,377 @@ DEFAULT_USER_TEMPLATE = {
     "history": []  # list of events: {date, type, xp, note}
 }
 
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    xp INTEGER NOT NULL DEFAULT 0,
+    streak INTEGER NOT NULL DEFAULT 0,
+    last_completed TEXT,
+    badges TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS idx_users_xp ON users(xp DESC);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    type TEXT NOT NULL,
+    xp INTEGER NOT NULL,
+    note TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_history_user ON history(user_id);
+"""
+
+USER_COLUMNS = "user_id, name, xp, streak, last_completed, badges"
+
+# dirty users are written back to SQLite in batches this often (seconds)
+FLUSH_INTERVAL = 0.5
+# max users kept in memory; only clean (already written) users are evicted
+USER_CACHE_SIZE = 1024
+
 # -------------------------
-# Utility: load + save (atomic write)
+# Utility: connection + row mapping
 # -------------------------
-def _load_db():
-    if not DATA_FILE.exists():
-        initial = {"users": []}
-        _atomic_write(initial)
-        return initial
+# one shared connection; sqlite3 objects aren't safe to use concurrently,
+# so every access goes through _DB_LOCK
+_DB_LOCK = threading.RLock()
+_conn = None
+
+# write-back LRU cache: users are loaded lazily, mutated in memory and flushed
+# by a background thread. Dirty users and users in a flush that hasn't been
+# committed yet are never evicted, so a cache miss can safely read from SQLite.
+# Lock order is _CACHE_LOCK -> _DB_LOCK.
+_CACHE_LOCK = threading.RLock()
+_USER_CACHE = OrderedDict()  # user_id -> user dict (incl. history), oldest first
+# user_ids whose row needs writing, in the order they were first dirtied. A
+# dict, not a set: flush upserts in this order, so new users get rowids in
+# signup order (leaderboard ties and export_db rely on that).
+_DIRTY = {}
+_IN_FLIGHT = set()           # user_ids taken by the running flush, not yet committed
+_PENDING_EVENTS = []   # history events not yet inserted
+_flusher = None
+_flusher_stop = threading.Event()
+# serializes whole flushes (snapshot + write) so an older snapshot can never
+# be written after a newer one. Lock order is _FLUSH_LOCK -> _CACHE_LOCK.
+_FLUSH_LOCK = threading.Lock()
+
+def _connect():
+    conn = sqlite3.connect(str(DB_FILE), check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    _import_legacy_json(conn)
+    return conn
+
+def _get_conn():
+    global _conn
+    with _DB_LOCK:
+        if _conn is None:
+            _conn = _connect()
+        return _conn
+
+def _import_legacy_json(conn):
+    if not LEGACY_DATA_FILE.exists():
+        return
+    if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+        return
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        users = orjson.loads(LEGACY_DATA_FILE.read_bytes()).get("users", [])
     except Exception:
-        # if corrupted, recreate
-        initial = {"users": []}
-        _atomic_write(initial)
-        return initial
+        return
+    with conn:
+        for u in users:
+            conn.execute(
+                f"INSERT OR IGNORE INTO users ({USER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                (u["user_id"], u.get("name", ""), int(u.get("xp", 0)), int(u.get("streak", 0)),
+                 u.get("last_completed"), orjson.dumps(u.get("badges", [])).decode()))
+            conn.executemany(
+                "INSERT INTO history (user_id, date, type, xp, note) VALUES (?, ?, ?, ?, ?)",
+                [(u["user_id"], e.get("date", ""), e.get("type", ""), int(e.get("xp", 0)), e.get("note", ""))
+                 for e in u.get("history", [])])
+
+def _row_to_user(row, history):
+    return {
+        "user_id": row["user_id"],
+        "name": row["name"],
+        "xp": row["xp"],
+        "streak": row["streak"],
+        "last_completed": row["last_completed"],
+        "badges": orjson.loads(row["badges"]),
+        "history": history
+    }
+
+def _load_histories(conn, user_ids):
+    """history lists for several users in one query"""
+    histories = {uid: [] for uid in user_ids}
+    if not user_ids:
+        return histories
+    marks = ",".join("?" * len(user_ids))
+    rows = conn.execute(
+        f"SELECT user_id, date, type, xp, note FROM history WHERE user_id IN ({marks}) ORDER BY id",
+        list(user_ids))
+    for r in rows:
+        histories[r["user_id"]].append({"date": r["date"], "type": r["type"], "xp": r["xp"], "note": r["note"]})
+    return histories
+
+def _rows_to_users(conn, rows):
+    histories = _load_histories(conn, [r["user_id"] for r in rows])
+    return [_row_to_user(r, histories[r["user_id"]]) for r in rows]
+
+def _find_user(user_id):
+    with _CACHE_LOCK:
+        user = _USER_CACHE.get(user_id)
+        if user is not None:
+            _USER_CACHE.move_to_end(user_id)
+            return user
+        with _DB_LOCK:
+            conn = _get_conn()
+            row = conn.execute(f"SELECT {USER_COLUMNS} FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            user = _rows_to_users(conn, [row])[0]
+        _USER_CACHE[user_id] = user
+        _evict_clean()
+        return user
+
+def _evict_clean():
+    """drop least recently used clean users beyond USER_CACHE_SIZE (caller holds _CACHE_LOCK)"""
+    excess = len(_USER_CACHE) - USER_CACHE_SIZE
+    if excess <= 0:
+        return
+    victims = []
+    for uid in _USER_CACHE:
+        if uid not in _DIRTY and uid not in _IN_FLIGHT:
+            victims.append(uid)
+            if len(victims) == excess:
+                break
+    for uid in victims:
+        del _USER_CACHE[uid]
 
-def _atomic_write(obj):
-    tmpfd, tmppath = tempfile.mkstemp(prefix="pg_", suffix=".json", dir=str(DATA_FILE.parent))
-    with os.fdopen(tmpfd, "w", encoding="utf-8") as f:
-        json.dump(obj, f, indent=2)
-    os.replace(tmppath, DATA_FILE)
+def _save_user(user, new_events=()):
+    """mark the user dirty; the flusher writes it (and new events) later"""
+    with _CACHE_LOCK:
+        _USER_CACHE[user["user_id"]] = user
+        _USER_CACHE.move_to_end(user["user_id"])
+        _DIRTY.setdefault(user["user_id"])
+        _PENDING_EVENTS.extend((user["user_id"], e["date"], e["type"], e["xp"], e["note"]) for e in new_events)
+    _ensure_flusher()
 
-def _save_db(db):
-    _atomic_write(db)
+def flush():
+    """write all dirty users and pending history events in one transaction"""
+    # request threads only wait on _CACHE_LOCK for the snapshot, not the write
+    with _FLUSH_LOCK:
+        with _CACHE_LOCK:
+            if not _DIRTY and not _PENDING_EVENTS:
+                return
+            rows = [(u["user_id"], u["name"], int(u["xp"]), int(u["streak"]), u["last_completed"],
+                     orjson.dumps(u["badges"]).decode())
+                    for u in (_USER_CACHE[uid] for uid in _DIRTY)]
+            events = list(_PENDING_EVENTS)
+            _IN_FLIGHT.update(_DIRTY)
+            _DIRTY.clear()
+            _PENDING_EVENTS.clear()
+        try:
+            with _DB_LOCK:
+                conn = _get_conn()
+                with conn:
+                    conn.executemany(
+                        f"INSERT INTO users ({USER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET name = excluded.name, xp = excluded.xp, "
+                        "streak = excluded.streak, last_completed = excluded.last_completed, badges = excluded.badges",
+                        rows)
+                    conn.executemany("INSERT INTO history (user_id, date, type, xp, note) VALUES (?, ?, ?, ?, ?)",
+                                     events)
+        except Exception:
+            # transaction rolled back: keep everything queued for the next flush
+            with _CACHE_LOCK:
+                # failed users go back in front of anything dirtied since
+                newer = list(_DIRTY)
+                _DIRTY.clear()
+                _DIRTY.update(dict.fromkeys(r[0] for r in rows))
+                _DIRTY.update(dict.fromkeys(newer))
+                _PENDING_EVENTS[:0] = events
+                _IN_FLIGHT.clear()
+            raise
+        with _CACHE_LOCK:
+            # these users are now clean in SQLite and may be evicted
+            _IN_FLIGHT.clear()
+            _evict_clean()
 
-def _find_user(db, user_id):
-    for u in db["users"]:
-        if u.get("user_id") == user_id:
-            return u
-    return None
+def _flush_loop():
+    while not _flusher_stop.wait(FLUSH_INTERVAL):
+        try:
+            flush()
+        except Exception:
+            pass
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _CACHE_LOCK:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name="gamification-flush", daemon=True)
+            _flusher.start()
+
+def _shutdown():
+    _flusher_stop.set()
+    flush()
+
+atexit.register(_shutdown)
 
 # -------------------------
 # API: create or get user
 # -------------------------
 def get_or_create_user(user_id, name=""):
-    db = _load_db()
-    user = _find_user(db, user_id)
-    if user:
-        return user
-    # create
-    new = DEFAULT_USER_TEMPLATE.copy()
-    new["user_id"] = user_id
-    new["name"] = name or user_id.split("@")[0]
-    db["users"].append(new)
-    _save_db(db)
+    with _CACHE_LOCK:
+        user = _find_user(user_id)
+        if user:
+            return user
+        # create
+        new = DEFAULT_USER_TEMPLATE.copy()
+        new["user_id"] = user_id
+        new["name"] = name or user_id.split("@")[0]
+        new["badges"] = []
+        new["history"] = []
+        _save_user(new)
     return new
 
 # -------------------------
 # Award XP, add badge
 # -------------------------
 def _award_xp_to_user(user, amount, note=None, event_type="custom"):
+    """updates the user dict in place and returns the new history event"""
     user["xp"] = int(user.get("xp", 0)) + int(amount)
     # append history
-    user.setdefault("history", []).append({
-        "date": datetime.now().strftime("%Y-%m-%d"),
+    event = {
+        "date": date.today().isoformat(),
         "type": event_type,
         "xp": int(amount),
         "note": note or ""
-    })
-    # check badges
-    for thresh, name in sorted(BADGE_THRESHOLDS.items()):
-        if user["xp"] >= thresh and name not in user.get("badges", []):
-            user.setdefault("badges", []).append(name)
+    }
+    user.setdefault("history", []).append(event)
+    # check badges (thresholds ascending, so stop at the first one not reached)
+    badges = user.setdefault("badges", [])
+    owned = set(badges)
+    for thresh, name in _SORTED_THRESHOLDS:
+        if user["xp"] < thresh:
+            break
+        if name not in owned:
+            badges.append(name)
+    return event
 
 # -------------------------
 # Mark daily completion (returns (ok, msg))
 # -------------------------
 def mark_daily_completion(user_id, note="", daily_xp=10):
-    db = _load_db()
-    user = _find_user(db, user_id)
-    if not user:
+    with _CACHE_LOCK:
         user = get_or_create_user(user_id)
 
-    today = datetime.now().date()
-    last = user.get("last_completed")
-    if last:
-        last_date = datetime.strptime(last, "%Y-%m-%d").date()
-    else:
-        last_date = None
-
-    if last_date == today:
-        _save_db(db)
-        return False, "Already marked today."
-
-    # update streak
-    if last_date:
-        if (today - last_date).days == 1:
-            user["streak"] = int(user.get("streak", 0)) + 1
+        today = date.today()
+        last = user.get("last_completed")
+        if last:
+            last_date = date.fromisoformat(last)
+        else:
+            last_date = None
+
+        if last_date == today:
+            return False, "Already marked today."
+
+        # update streak
+        if last_date:
+            if (today - last_date).days == 1:
+                user["streak"] = int(user.get("streak", 0)) + 1
+            else:
+                user["streak"] = 1
         else:
             user["streak"] = 1
-    else:
-        user["streak"] = 1
 
-    user["last_completed"] = today.strftime("%Y-%m-%d")
-    _award_xp_to_user(user, daily_xp, note=note, event_type="completion")
-    _save_db(db)
+        user["last_completed"] = today.isoformat()
+        event = _award_xp_to_user(user, daily_xp, note=note, event_type="completion")
+        _save_user(user, [event])
     return True, f"Awarded {daily_xp} XP. Current streak: {user['streak']}"
 
 # -------------------------
 # Mark upload (giving XP for uploading/analysis)
 # -------------------------
 def mark_upload(user_id, note="", upload_xp=20):
-    db = _load_db()
-    user = _find_user(db, user_id)
-    if not user:
+    with _CACHE_LOCK:
         user = get_or_create_user(user_id)
-    _award_xp_to_user(user, upload_xp, note=note, event_type="upload")
-    _save_db(db)
+        event = _award_xp_to_user(user, upload_xp, note=note, event_type="upload")
+        _save_user(user, [event])
     return True, f"Awarded {upload_xp} XP for upload."
 
 # -------------------------
 # Manual award (for quests etc.)
 # -------------------------
 def award_xp(user_id, amount, note="", event_type="manual"):
-    db = _load_db()
-    user = _find_user(db, user_id)
-    if not user:
+    with _CACHE_LOCK:
         user = get_or_create_user(user_id)
-    _award_xp_to_user(user, amount, note=note, event_type=event_type)
-    _save_db(db)
+        event = _award_xp_to_user(user, amount, note=note, event_type=event_type)
+        _save_user(user, [event])
     return True, f"Awarded {amount} XP."
 
 # -------------------------
 # Get user progress
 # -------------------------
 def get_user(user_id):
-    db = _load_db()
-    user = _find_user(db, user_id)
-    if not user:
-        return None
-    return user
+    return _find_user(user_id)
 
 # -------------------------
 # Leaderboard (top N)
 # -------------------------
-def get_leaderboard(top_n=10):
-    db = _load_db()
-    users = db.get("users", [])
-    users_sorted = sorted(users, key=lambda u: u.get("xp", 0), reverse=True)
-    return users_sorted[:top_n]
+def get_leaderboard(top_n=10, with_history=True):
+    # idx_users_xp already holds users in (xp DESC, rowid) order, so this is an
+    # index walk that stops after top_n rows - no sort, no full scan. rowid
+    # breaks ties by signup order, like the old stable sort did.
+    flush()
+    with _CACHE_LOCK:
+        with _DB_LOCK:
+            conn = _get_conn()
+            rows = conn.execute(f"SELECT {USER_COLUMNS} FROM users ORDER BY xp DESC, rowid LIMIT ?",
+                                (int(top_n),)).fetchall()
+            if not with_history:
+                return [{k: v for k, v in _row_to_user(r, None).items() if k != "history"} for r in rows]
+            # only users not already cached need their history loaded
+            missing = [r for r in rows if r["user_id"] not in _USER_CACHE]
+            loaded = {u["user_id"]: u for u in _rows_to_users(conn, missing)}
+        return [_USER_CACHE.get(r["user_id"]) or loaded[r["user_id"]] for r in rows]
+
+# -------------------------
+# Rank of one user (dense: equal XP shares a rank)
+# -------------------------
+def get_rank(user_id):
+    flush()
+    with _DB_LOCK:
+        row = _get_conn().execute(
+            "SELECT u.xp, u.streak, "
+            "1 + (SELECT COUNT(DISTINCT xp) FROM users WHERE xp > u.xp) AS rank "
+            "FROM users u WHERE u.user_id = ?", (user_id,)).fetchone()
+    if row is None:
+        return None
+    return {"rank": row["rank"], "xp": row["xp"], "streak": row["streak"]}
 
 # -------------------------
 # Reset user streak (utility)
 # -------------------------
 def reset_streak(user_id):
-    db = _load_db()
-    user = _find_user(db, user_id)
-    if not user:
-        return False, "User not found"
-    user["streak"] = 0
-    user["last_completed"] = None
-    _save_db(db)
+    with _CACHE_LOCK:
+        user = _find_user(user_id)
+        if not user:
+            return False, "User not found"
+        user["streak"] = 0
+        user["last_completed"] = None
+        _save_user(user)
     return True, "Streak reset."
 
 # -------------------------
 # Export DB (for debugging)
 # -------------------------
 def export_db():
-    return _load_db()
+    flush()
+    with _DB_LOCK:
+        conn = _get_conn()
+        rows = conn.execute(f"SELECT {USER_COLUMNS} FROM users ORDER BY rowid").fetchall()
+        return {"users": _rows_to_users(conn, rows)}
@@ -4,23 +4,28 @@ import joblib, os, numpy as np
 MODEL_PATH = "workout_model.pkl"
 ENCODERS_PATH = "label_encoders.pkl"
 
-def predict_workout(age=30, bmi=24.0, condition="None", experience_level="Beginner", pain_level=0):
-    """
-    Loads model+encoders if available. If not, returns a rule-based fallback.
-    """
+def _load_artifacts():
+    """Load model+encoders once; (None, None) when they're missing or broken."""
     try:
         if os.path.exists(MODEL_PATH) and os.path.exists(ENCODERS_PATH):
-            model = joblib.load(MODEL_PATH)
-            encoders = joblib.load(ENCODERS_PATH)
-            cond_enc = encoders["condition"].transform([condition])[0]
-            exp_enc = encoders["experience_level"].transform([experience_level])[0]
-            X = np.array([[age, bmi, cond_enc, exp_enc, int(pain_level)]])
-            y = model.predict(X)[0]
-            return encoders["workout_type"].inverse_transform([y])[0]
+            return joblib.load(MODEL_PATH), joblib.load(ENCODERS_PATH)
     except Exception:
         pass
+    return None, None
+
+_MODEL, _ENCODERS = _load_artifacts()
 
-    # fallback rule-based
+# label -> code lookups, so a prediction doesn't go through LabelEncoder.transform
+if _ENCODERS is not None:
+    _COND_CODES = {c: i for i, c in enumerate(_ENCODERS["condition"].classes_)}
+    _EXP_CODES = {c: i for i, c in enumerate(_ENCODERS["experience_level"].classes_)}
+    _WORKOUT_CLASSES = _ENCODERS["workout_type"].classes_
+else:
+    _COND_CODES = _EXP_CODES = _WORKOUT_CLASSES = None
+
+DEFAULTS = {"age": 30, "bmi": 24.0, "condition": "None", "experience_level": "Beginner", "pain_level": 0}
+
+def _rule_based(age, bmi, condition, pain_level):
     if pain_level >= 6 or "back" in condition.lower() or "knee" in condition.lower() or "arthritis" in condition.lower():
         return "Rehab Physiotherapy"
     if bmi >= 30 or "obesity" in condition.lower():
@@ -28,3 +33,43 @@ def predict_workout(age=30, bmi=24.0, condition="None", experience_level="Beginn
     if age < 30 and int(pain_level) <= 2:
         return "Strength Training"
     return "General Wellness"
+
+def predict_workout_batch(records):
+    """
+    records: list of dicts with age, bmi, condition, experience_level, pain_level
+    (missing or None values use the predict_workout defaults). All records the
+    model can encode are predicted with a single model.predict call; the rest (unknown
+    labels, no model on disk) use the rule-based fallback.
+    """
+    records = [{**DEFAULTS, **{k: v for k, v in r.items() if v is not None}} for r in records]
+    out = [None] * len(records)
+
+    if _MODEL is not None:
+        rows, idx = [], []
+        for i, r in enumerate(records):
+            try:
+                # coerce here so one bad value only drops its own row
+                rows.append((float(r["age"]), float(r["bmi"]), _COND_CODES[r["condition"]],
+                             _EXP_CODES[r["experience_level"]], int(r["pain_level"])))
+                idx.append(i)
+            except Exception:
+                pass
+        if rows:
+            try:
+                X = np.array(rows, dtype=np.float32)
+                for i, label in zip(idx, _WORKOUT_CLASSES[_MODEL.predict(X)]):
+                    out[i] = label
+            except Exception:
+                pass
+
+    for i, r in enumerate(records):
+        if out[i] is None:
+            out[i] = _rule_based(r["age"], r["bmi"], r["condition"], r["pain_level"])
+    return out
+
+def predict_workout(age=30, bmi=24.0, condition="None", experience_level="Beginner", pain_level=0):
+    """
+    Uses the preloaded model+encoders if available. If not, returns a rule-based fallback.
+    """
+    return predict_workout_batch([{"age": age, "bmi": bmi, "condition": condition,
+                                   "experience_level": experience_level, "pain_level": pain_level}])[0]
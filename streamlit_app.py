@@ -2,9 +2,35 @@
 import streamlit as st
 import requests, json
 from io import BytesIO
+from requests.adapters import HTTPAdapter
 
 API_BASE = "http://127.0.0.1:5000/api"
 
+@st.cache_resource
+def get_session():
+    # one keep-alive pool shared across Streamlit reruns
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip"})
+    return session
+
+SESSION = get_session()
+
+def iter_sse(resp):
+    """yield (event, data) pairs from a text/event-stream response"""
+    event, data = "message", []
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+
 st.set_page_config(page_title="FitGenesis AI", layout="wide")
 st.title("💪 FitGenesis")
 
@@ -13,11 +39,11 @@ st.sidebar.header("User / Gamification")
 user_email = st.sidebar.text_input("User id (email)", value="user1@example.com")
 user_name = st.sidebar.text_input("Name", value="Kushal")
 if st.sidebar.button("Create / Load user"):
-    r = requests.post(f"{API_BASE}/user/create", json={"user_id": user_email, "name": user_name})
+    r = SESSION.post(f"{API_BASE}/user/create", json={"user_id": user_email, "name": user_name})
     st.sidebar.json(r.json())
 
 if st.sidebar.button("Refresh progress"):
-    r = requests.get(f"{API_BASE}/user/{user_email}")
+    r = SESSION.get(f"{API_BASE}/user/{user_email}")
     if r.status_code == 200:
         user = r.json()
         st.sidebar.metric("🔥 Streak", user.get("streak", 0))
@@ -28,15 +54,15 @@ if st.sidebar.button("Refresh progress"):
 
 st.sidebar.write("---")
 if st.sidebar.button("Mark Today Complete (+10 XP)"):
-    r = requests.post(f"{API_BASE}/user/{user_email}/complete", json={"note":"Completed AI plan"})
+    r = SESSION.post(f"{API_BASE}/user/{user_email}/complete", json={"note":"Completed AI plan"})
     st.sidebar.write(r.json())
 
 if st.sidebar.button("Mark Upload (+20 XP)"):
-    r = requests.post(f"{API_BASE}/user/{user_email}/upload", json={"note":"Uploaded MRI"})
+    r = SESSION.post(f"{API_BASE}/user/{user_email}/upload", json={"note":"Uploaded MRI"})
     st.sidebar.write(r.json())
 
 if st.sidebar.button("Leaderboard"):
-    r = requests.get(f"{API_BASE}/leaderboard?top=10")
+    r = SESSION.get(f"{API_BASE}/leaderboard?top=10")
     st.sidebar.dataframe(r.json())
 
 # Main area: upload
@@ -63,12 +89,29 @@ if submit:
             "pain_level": str(pain_level),
             "user_id": user_email
         }
+        res = None
         with st.spinner("Analyzing with AI..."):
-            r = requests.post(f"{API_BASE}/analyze", files=files, data=data)
+            r = SESSION.post(f"{API_BASE}/analyze/stream", files=files, data=data, stream=True)
+            if r.status_code == 200:
+                # show Gemini output as it streams in
+                live = st.empty()
+                streamed = ""
+                try:
+                    for event, payload in iter_sse(r):
+                        if event == "chunk":
+                            streamed += payload["text"]
+                            live.code(streamed)
+                        elif event == "result":
+                            res = payload
+                except requests.exceptions.RequestException:
+                    pass  # connection dropped mid-stream; res stays None
+                live.empty()
         if r.status_code != 200:
             st.error("Server error: " + r.text)
+        elif res is None:
+            # body was consumed by the stream, so r.text isn't available here
+            st.error("Server error: the analysis stream ended before a result arrived.")
         else:
-            res = r.json()
             st.subheader("🧾 Extracted / AI Result")
             st.json(res)
             # show simple view of plan
@@ -78,7 +121,7 @@ if submit:
                     st.markdown(f"**Day {d.get('day')}**: {', '.join(d.get('exercises',[]))}")
             # button to download PDF
             if st.button("Download PDF Report"):
-                rr = requests.post(f"{API_BASE}/report", json={"result": res})
+                rr = SESSION.post(f"{API_BASE}/report", json={"result": res})
                 
                 if rr.status_code == 200:
                     st.success("Report generated successfully.")
@@ -96,20 +139,33 @@ if submit:
 st.markdown("---")
 st.subheader("Demo Controls")
 if st.button("Show last 5 users (leaderboard)"):
-    r = requests.get(f"{API_BASE}/leaderboard?top=5")
+    r = SESSION.get(f"{API_BASE}/leaderboard?top=5")
     if r.status_code == 200:
         st.table(r.json())
 
 st.markdown("---")
 st.header("📊 Analytics Dashboard")
-import pandas as pd
+import polars as pl
 import plotly.express as px
 
+@st.cache_data(ttl=60)
+def history_frames(user_id, n_events, _hist):
+    """
+    History table + activity counts for the charts. History is append-only,
+    so (user_id, n_events) identifies it and the list itself isn't hashed.
+    """
+    df = (pl.from_dicts(_hist)
+          .with_columns(pl.col("date").str.to_date(), pl.col("type").cast(pl.Categorical))
+          .sort("date"))
+    pie = df.group_by("type").agg(pl.len().alias("count")).rename({"type": "activity_type"})
+    # plotly/streamlit get pandas only at render time
+    return df.to_pandas(), pie.to_pandas()
+
 st.markdown("### User Progress Analytics")
 
 if st.button("Load Analytics"):
     # fetch user data
-    r = requests.get(f"{API_BASE}/user/{user_email}")
+    r = SESSION.get(f"{API_BASE}/user/{user_email}")
     if r.status_code != 200:
         st.error("User not found. Create user first.")
     else:
@@ -135,10 +191,7 @@ if st.button("Load Analytics"):
         if len(hist) == 0:
             st.info("No history yet. Complete tasks to generate analytics.")
         else:
-            df = pd.DataFrame(hist)
-            # ensure date sorted
-            df['date'] = pd.to_datetime(df['date'])
-            df = df.sort_values('date')
+            df, pie = history_frames(user_email, len(hist), hist)
 
             fig = px.line(df, x='date', y='xp', markers=True,
                           title="XP Earned Per Day",
@@ -147,8 +200,6 @@ if st.button("Load Analytics"):
 
             # ---------- EVENT TYPE PIE CHART ----------
             st.subheader("🧠 Activity Distribution (uploads vs completions vs other)")
-            pie = df['type'].value_counts().reset_index()
-            pie.columns = ['activity_type', 'count']
             fig2 = px.pie(pie, names='activity_type', values='count',
                            title="Activity Breakdown")
             st.plotly_chart(fig2, use_container_width=True)
@@ -160,18 +211,18 @@ if st.button("Load Analytics"):
             st.write("---")
             st.subheader("🏆 Leaderboard Comparison")
 
-            r2 = requests.get(f"{API_BASE}/leaderboard?top=20")
+            r2 = SESSION.get(f"{API_BASE}/leaderboard",
+                             params={"top": 20, "fields": "name,user_id,xp,streak,rank"})
             if r2.status_code == 200:
-                lb = pd.DataFrame(r2.json())
+                lb = r2.json()
 
-                if not lb.empty:
-                    lb['rank'] = lb['xp'].rank(ascending=False, method='dense')
-                    st.dataframe(lb[['name', 'user_id', 'xp', 'streak', 'rank']])
+                if lb:
+                    st.dataframe(lb)
 
-                    # find current user rank
-                    match = lb[lb['user_id'] == user_email]
-                    if not match.empty:
-                        st.success(f"🏅 Your current rank: {int(match['rank'].values[0])}")
+                    # current user rank (computed server-side)
+                    r3 = SESSION.get(f"{API_BASE}/user/{user_email}/rank")
+                    if r3.status_code == 200:
+                        st.success(f"🏅 Your current rank: {r3.json()['rank']}")
                     else:
                         st.info("User not found in leaderboard")
                 else: